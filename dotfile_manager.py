@@ -1,111 +1,347 @@
 import os
-import subprocess
-import logging
+import functools
 import json
-import argparse
+import logging
+import shutil
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson rejects lone surrogates, which is how os.fsdecode represents file
+# names that don't decode in the current locale; stdlib json escapes them, so
+# fall back to it for those (and for anything written that way earlier).
+def _json_loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj)
+
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Stable for the life of the process, so look it up once.
+_HOME = Path.home()
+
+# Parallelism for submodule clones and fetches.
+GIT_JOBS = os.cpu_count() or 8
+
+# Symlink creation is syscall-bound and releases the GIL, so it scales with
+# threads well past the CPU count.
+SYMLINK_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Files linked per pool task, so a big directory like $HOME is still spread
+# across workers while each task keeps a single directory fd open.
+SYMLINK_CHUNK_SIZE = 16
+# Below this many tasks, starting the threads costs more than the parallelism
+# saves.
+SYMLINK_POOL_MIN_TASKS = 4
+
+# Directories are only opened to serve as dir_fd anchors, so O_PATH (Linux)
+# is enough where available.
+_DIR_OPEN_FLAGS = os.O_DIRECTORY | getattr(os, "O_PATH", os.O_RDONLY)
+
+
+def _spawn(argv, **kwargs):
+    """Run a command like subprocess.run, but through posix_spawn.
+
+    CPython only takes its posix_spawn path (instead of fork+exec) when the
+    executable has a directory component, close_fds is off and no cwd is
+    given, so resolve the executable up front and leave cwd to the caller.
+    """
+    import subprocess
+
+    executable = shutil.which(argv[0]) or argv[0]
+    return subprocess.run([executable, *argv[1:]], close_fds=False, **kwargs)
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=4)
+def _read_json(path, mtime_ns):
+    """Parse a JSON file, memoized on its modification time.
+
+    Callers pass the current mtime from _mtime_ns(), so an unchanged file is
+    served from the cache and a rewritten one is parsed again.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return _json_loads(f.read())
+
+
+@functools.lru_cache(maxsize=4)
+def _read_metadata(path, mtime_ns):
+    """Parse metadata.jsonl, memoized on its modification time like _read_json.
+
+    The file holds one JSON-encoded path per line, so adding an entry is a
+    single append. Records are split on "\n" only: orjson writes characters
+    such as U+2028 unescaped, and str.splitlines() would break on those.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return tuple(_json_loads(line) for line in f.read().split("\n") if line)
+
 
 class DotfileManager:
     def __init__(self, repo_url=None, dotfiles_dir="dotfiles"):
         self.repo_url = repo_url
         self.dotfiles_dir = Path(dotfiles_dir).absolute()
-        self.config_file = Path.home() / ".dotfile"
-        self.meta_data_file = self.dotfiles_dir / "metadata.json"
+        self.config_file = _HOME / ".dotfile"
+        self.meta_data_file = self.dotfiles_dir / "metadata.jsonl"
+        # Single JSON array written by older versions, see get_metadata.
+        self.legacy_meta_data_file = self.dotfiles_dir / "metadata.json"
         self.meta_data = []
+        self._legacy_metadata = False
+        # Paths added since the last flush(), not yet in metadata.jsonl.
+        self._pending = []
         self.load_config()
+        self.get_metadata()
 
     def load_config(self):
-        if os.path.exists(self.config_file):
-            with open(self.config_file, "r") as f:
-                config = json.load(f)
-                self.repo_url = config.get("repo_url", self.repo_url)
-                self.dotfiles_dir = Path(
-                    config.get("dotfiles_dir", self.dotfiles_dir)
-                ).absolute()
-                self.meta_data_file = self.dotfiles_dir / "metadata.json"
+        mtime_ns = _mtime_ns(self.config_file)
+        if mtime_ns is not None:
+            config = _read_json(self.config_file, mtime_ns)
+            self.repo_url = config.get("repo_url", self.repo_url)
+            self.dotfiles_dir = Path(
+                config.get("dotfiles_dir", self.dotfiles_dir)
+            ).absolute()
+            self.meta_data_file = self.dotfiles_dir / "metadata.jsonl"
+            self.legacy_meta_data_file = self.dotfiles_dir / "metadata.json"
         else:
             logging.info(f"No configuration file found at {self.config_file}")
 
     def get_metadata(self):
-        if os.path.exists(self.meta_data_file):
-            with open(self.meta_data_file, "r") as f:
-                self.meta_data = json.load(f)
+        self._legacy_metadata = False
+        mtime_ns = _mtime_ns(self.meta_data_file)
+        if mtime_ns is not None:
+            self.meta_data = list(_read_metadata(self.meta_data_file, mtime_ns))
+            return self.meta_data
+        # Repositories last written by an older version only have the JSON
+        # array; the next add carries its entries over to metadata.jsonl.
+        mtime_ns = _mtime_ns(self.legacy_meta_data_file)
+        if mtime_ns is not None:
+            self.meta_data = list(_read_json(self.legacy_meta_data_file, mtime_ns))
+            self._legacy_metadata = True
         else:
             self.meta_data = []
         return self.meta_data
 
-    def add_to_metadata(self, data):
-        data = str(data)
-        self.get_metadata()
-        self.meta_data.append(data)
-        with open(self.meta_data_file, "w") as f:
-            json.dump(self.meta_data, f)
+    def add_to_metadata(self, *data):
+        data = [str(entry) for entry in data]
+        # self.meta_data is loaded in __init__, no need to re-read the file.
+        self.meta_data.extend(data)
+        if self._legacy_metadata:
+            # First add since the move from metadata.json: start the new file
+            # with every entry. The old file is left alone for older versions.
+            with open(self.meta_data_file, "w", encoding="utf-8") as f:
+                f.writelines(_json_dumps(entry) + "\n" for entry in self.meta_data)
+            self._legacy_metadata = False
+        else:
+            with open(self.meta_data_file, "a", encoding="utf-8") as f:
+                f.write("".join(_json_dumps(entry) + "\n" for entry in data))
+
+    def flush(self):
+        """Record pending adds in the metadata and sync them in one go."""
+        if not self._pending:
+            return
+        self.add_to_metadata(*self._pending)
+        self._pending = []
+        self.update_repo()
 
     def save_config(self):
-        dotfiles_path = str(self.dotfiles_dir.absolute())
+        # Already absolute, see __init__ and load_config.
+        dotfiles_path = str(self.dotfiles_dir)
         config = {
             "repo_url": self.repo_url,
             "dotfiles_dir": dotfiles_path,
         }
-        with open(self.config_file, "w+") as f:
-            json.dump(config, f)
+        with open(self.config_file, "w+", encoding="utf-8") as f:
+            f.write(_json_dumps(config))
         logging.info(f"Configuration saved to {self.config_file}")
 
     def clone_repo(self):
         if not os.path.exists(self.dotfiles_dir):
             logging.info(f"Cloning repository {self.repo_url} into {self.dotfiles_dir}")
-            subprocess.run(
-                ["git", "clone", self.repo_url, self.dotfiles_dir], check=True
+            _spawn(
+                [
+                    "git",
+                    "clone",
+                    # Only the tip of the branch is needed for the dotfiles.
+                    "--depth=1",
+                    "--filter=blob:none",
+                    "--single-branch",
+                    "--recurse-submodules",
+                    f"--jobs={GIT_JOBS}",
+                    self.repo_url,
+                    self.dotfiles_dir,
+                ],
+                check=True,
             )
         else:
             logging.info(f"Repository already cloned in {self.dotfiles_dir}")
 
     def create_symlinks(self):
+        # Group the entries by parent directory so each one is created and
+        # opened once; symlink then resolves a bare name against that fd
+        # instead of walking the whole absolute path again for every file.
+        # Entries are absolute paths, so plain string operations are enough.
+        dotfiles_dir = str(self.dotfiles_dir)
+        by_parent = {}
         for file in self.get_metadata():
-            file = Path(file)
-            if os.path.exists(file):
-                logging.warning(f"Target path {file} already exists. Skipping.")
-            else:
-                dotfile_path = self.dotfiles_dir / file.relative_to("/")
-                os.makedirs(os.path.dirname(file), exist_ok=True)
-                os.symlink(dotfile_path, file)
-                logging.info(f"Created symlink: {file} -> {dotfile_path}")
+            parent, _, name = file.rpartition("/")
+            by_parent.setdefault(parent or "/", []).append((file, name))
+        # Create every parent up front so the worker threads never race each
+        # other on mkdir.
+        for parent in by_parent:
+            os.makedirs(parent, exist_ok=True)
+        tasks = [
+            (parent, files[i : i + SYMLINK_CHUNK_SIZE])
+            for parent, files in by_parent.items()
+            for i in range(0, len(files), SYMLINK_CHUNK_SIZE)
+        ]
+        if len(tasks) < SYMLINK_POOL_MIN_TASKS:
+            for parent, files in tasks:
+                self._link_parent(dotfiles_dir, parent, files)
+            return
 
-    def update_repo(self):
-        logging.info(f"Updating repository in {self.dotfiles_dir}")
-        subprocess.run(
-            ["git", "-C", self.dotfiles_dir, "add", "."],
-            check=True,
-        )
-        changes = True
-        try:
-            subprocess.run(
-                ["git", "-C", self.dotfiles_dir, "commit", "-m", '"Update config"'],
-                check=True,
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Each task opens one directory fd, so at most SYMLINK_WORKERS are
+        # open at once.
+        with ThreadPoolExecutor(max_workers=SYMLINK_WORKERS) as executor:
+            # Consume the results so errors from workers are raised here.
+            list(
+                executor.map(
+                    lambda task: self._link_parent(dotfiles_dir, *task), tasks
+                )
             )
-        except Exception:
-            logging.info("No changes to sync up.")
-            changes = False
 
+    def _link_parent(self, dotfiles_dir, parent, files):
+        parent_fd = os.open(parent, _DIR_OPEN_FLAGS)
+        try:
+            for file, name in files:
+                dotfile_path = dotfiles_dir + file
+                # Let symlink itself report an existing target (including a
+                # dangling link) instead of checking first: one syscall, and
+                # no race window.
+                try:
+                    os.symlink(dotfile_path, name, dir_fd=parent_fd)
+                except FileExistsError:
+                    logging.warning(f"Target path {file} already exists. Skipping.")
+                else:
+                    logging.info(f"Created symlink: {file} -> {dotfile_path}")
+        finally:
+            os.close(parent_fd)
+
+    def update_repo(self):
+        import subprocess
+
+        logging.info(f"Updating repository in {self.dotfiles_dir}")
+        # One shell for the whole add/commit/pull/push sequence instead of a
+        # fork+exec from this process per git command.
+        script = f"""
+            # Send git's output straight to the terminal (stderr); only the
+            # NOCOMMIT marker goes to fd 3, the captured stdout.
+            exec 3>&1 1>&2
+            cd "$1" || exit 1
+            shift
+            # Only the paths the manager tracks, not a scan of the worktree,
+            # taken literally so names with * ? [ are not globbed. An empty
+            # list must not reach git add -A, which would add everything.
+            if [ "$#" -gt 0 ]; then
+                git --literal-pathspecs add -A -- "$@" || exit 1
+            fi
+            # diff --quiet stops at the first staged change, so the usual
+            # nothing-to-sync case never runs git commit at all.
+            if git diff --cached --quiet; then
+                echo NOCOMMIT >&3
+                changes=0
+            else
+                git commit -m "Update config" || exit 1
+                changes=1
+            fi
+            git pull origin main --rebase --recurse-submodules --jobs={GIT_JOBS} \\
+                || echo "git pull failed" >&2
+            if [ "$changes" = 1 ]; then
+                git push origin main || exit 1
+            fi
+        """
+        # Metadata entries are absolute, so stripping the leading / gives their
+        # path inside the repository. Entries missing from the worktree are
+        # left out, since git add fails on a pathspec that matches nothing.
+        dotfiles_dir = str(self.dotfiles_dir)
+        paths = [self.meta_data_file.name]
+        paths += [file[1:] for file in self.get_metadata()]
+        paths = [path for path in paths if os.path.lexists(f"{dotfiles_dir}/{path}")]
+        paths = self._drop_ignored(paths)
         try:
-            subprocess.run(
-                ["git", "-C", self.dotfiles_dir, "pull", "origin", "main", "--rebase"],
+            result = _spawn(
+                ["sh", "-c", script, "sh", self.dotfiles_dir, *paths],
+                stdout=subprocess.PIPE,
+                text=True,
                 check=True,
             )
-        except Exception as e:
-            print(e)
-        if changes:
-            subprocess.run(
-                ["git", "-C", self.dotfiles_dir, "push", "origin", "main"],
-                check=True,
+        except subprocess.CalledProcessError as e:
+            logging.error(
+                f"Updating {self.dotfiles_dir} failed (exit status {e.returncode})."
             )
+        else:
+            if "NOCOMMIT" in result.stdout.split():
+                logging.info("No changes to sync up.")
+        # Link even when git failed: the files are already in the worktree,
+        # and anything just added has been moved to .bak by now.
         self.create_symlinks()
 
+    def _drop_ignored(self, paths):
+        # git add fails outright on an ignored path given by name, where
+        # `git add .` just skipped it, so leave those out (with a warning)
+        # rather than let one entry break every sync.
+        import subprocess
+
+        if not paths:
+            return paths
+        result = _spawn(
+            [
+                "git",
+                "-C",
+                self.dotfiles_dir,
+                "check-ignore",
+                "-z",
+                "--stdin",
+            ],
+            input=b"\0".join(map(os.fsencode, paths)),
+            stdout=subprocess.PIPE,
+        )
+        # Exit status 1 means nothing is ignored; anything else but 0 is an
+        # error, which the git add in the sync script will report.
+        if result.returncode != 0:
+            return paths
+        ignored = {os.fsdecode(path) for path in result.stdout.split(b"\0") if path}
+        for path in ignored:
+            logging.warning(
+                f"{self.dotfiles_dir / path} is ignored by the repository's "
+                ".gitignore. Not syncing it."
+            )
+        return [path for path in paths if path not in ignored]
+
     def init(self):
         self.clone_repo()
         self.save_config()
@@ -120,13 +356,13 @@ class DotfileManager:
                 f"Dotfile {target_path} already exists in the repository. Skipping."
             )
         else:
-            self.add_to_metadata(file_path)
             os.makedirs(target_path.parent, exist_ok=True)
-            backup_path = file_path.with_suffix(str(file_path.suffix) + ".bak")
-            os.rename(file_path, backup_path)
-            subprocess.run(["cp", backup_path, target_path], check=True)
+            backup_path = str(file_path) + ".bak"
+            # Copy first so the original stays put if the copy fails.
+            shutil.copy2(file_path, target_path)
+            os.replace(file_path, backup_path)
             logging.info(f"Added dotfile: {file_path} -> {target_path}")
-            self.update_repo()
+            self._pending.append(file_path)
 
     def add_folder(self, folder_path):
         folder_path = Path(folder_path)
@@ -142,26 +378,28 @@ class DotfileManager:
                 # Git repositories aren't supported
                 pass
             else:
-                self.add_to_metadata(folder_path)
                 os.makedirs(target_path.parent, exist_ok=True)
-                subprocess.run(["cp", "-r", folder_path, target_path], check=True)
+                shutil.copytree(folder_path, target_path, symlinks=True)
                 logging.info(f"Added folder: {folder_path} -> {target_path}")
                 # back up the folder
-                subprocess.run(
-                    ["mv", folder_path, str(folder_path) + ".bak"], check=True
-                )
+                shutil.move(folder_path, str(folder_path) + ".bak")
                 logging.info(f"Created symlink: {folder_path} -> {target_path}")
-                self.update_repo()
+                self._pending.append(folder_path)
 
 
 if __name__ == "__main__":
+    # Only needed for the CLI; keeps imports of this module cheap.
+    import argparse
+
     parser = argparse.ArgumentParser(description="Manage your dotfiles")
     parser.add_argument(
         "--sync", action="store_true", help="Update the dotfiles repository"
     )
     parser.add_argument("--init", help="Initialize with the given repository URL")
     parser.add_argument("-d", help="Clone the repository in the given directory")
-    parser.add_argument("--add", help="Add a dotfile or folder to the repository")
+    parser.add_argument(
+        "--add", nargs="+", help="Add dotfiles or folders to the repository"
+    )
     args = parser.parse_args()
 
     script_path = Path(__file__).absolute()
@@ -176,11 +414,15 @@ if __name__ == "__main__":
         manager.init()
     elif args.add:
         manager = DotfileManager()
-        add_path = Path(args.add)
-        if add_path.is_dir():
-            manager.add_folder(add_path)
-        else:
-            manager.add_dotfile(add_path)
+        try:
+            for add_path in map(Path, args.add):
+                if add_path.is_dir():
+                    manager.add_folder(add_path)
+                else:
+                    manager.add_dotfile(add_path)
+        finally:
+            # Record whatever was copied, even if a later path failed.
+            manager.flush()
     else:
         # TODO: print usage
         pass